@@ -1,6 +1,5 @@
 import argparse
 import asyncio
-import glob
 import logging
 import os
 import shutil
@@ -9,7 +8,7 @@ import traceback
 import zipfile
 from datetime import UTC, datetime
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Set
 
 import aiohttp
 from tqdm.asyncio import tqdm
@@ -17,11 +16,13 @@ from tqdm.asyncio import tqdm
 from models import Error, Firmware, Ok, Response, Result
 from scrape_key import decrypt_dmg
 from utils.download import download_file
-from utils.fs import (bundles_glob, delete_non_bundles,
-                      is_firmware_version_done, is_firmware_version_ignored,
-                      put_metadata, system_has_parent)
+from utils.fs import (bundles_glob, bundles_scratch_dir, delete_non_bundles,
+                      extend_list, flush_metadata, forget_metadata,
+                      get_done_firmware_versions,
+                      get_ignored_firmware_versions, put_metadata,
+                      system_has_parent, verified_stamp_path)
 from utils.git import process_files_with_git
-from utils.hash import calculate_hash
+from utils.hash import HashingWriter
 from utils.shell import run_command
 
 logging.basicConfig(
@@ -31,6 +32,8 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+COPY_BUFFER_SIZE = 1 << 20
+
 PRODUCT_CODES: Dict[str, List[str]] = {
     "iPad": [
         "16,6",
@@ -109,7 +112,6 @@ PRODUCT_CODES: Dict[str, List[str]] = {
         "10,6",
         "10,5",
         "10,4",
-        "10,4",
         "10,2",
         "10,1",
         "9,4",
@@ -136,23 +138,38 @@ PRODUCT_CODES: Dict[str, List[str]] = {
 }
 
 
-async def decrypt_dmg_aea(
-    ipsw_file: Path, dmg_file: Path, output: Path
-) -> Result[None, str]:
-    logger.info(f"decrypting {dmg_file}")
+async def ensure_ipsw_installed() -> None:
+    """
+    `ipsw` is needed to decrypt the .dmg.aea files, install it once before any job starts
+    """
+    if shutil.which("ipsw") is not None:
+        return
 
-    if shutil.which("ipsw") is None:
-        logger.warning("ipsw is not installed")
-        deb_path = Path("ipsw.deb")
+    logger.warning("ipsw is not installed, installing it")
+    deb_path = Path("ipsw.deb")
 
+    try:
         if not deb_path.exists():
             await run_command(
                     f"wget https://github.com/blacktop/ipsw/releases/download/v3.1.544/ipsw_3.1.544_linux_x86_64.deb --output-document {deb_path}"
             )
 
         await run_command(f"sudo dpkg -i {deb_path}")
+    # OSError when wget, sudo or dpkg themselves are missing
+    except (RuntimeError, OSError) as e:
+        raise SystemExit(f"Unable to install ipsw: {e}")
+    finally:
         deb_path.unlink(missing_ok=True)
 
+    if shutil.which("ipsw") is None:
+        raise SystemExit("ipsw is still not available after installing it")
+
+
+async def decrypt_dmg_aea(
+    ipsw_file: Path, dmg_file: Path, output: Path
+) -> Result[None, str]:
+    logger.info(f"decrypting {dmg_file}")
+
     try:
         await run_command(
             f"ipsw extract --fcs-key {ipsw_file} --output {output}"
@@ -160,7 +177,7 @@ async def decrypt_dmg_aea(
     except Exception as e:
         return Error(f"Extraction failed: {e}")
 
-    pem_files = [Path(p) for p in glob.glob(f"{output}/**/*.pem")]
+    pem_files = list(output.rglob("*.pem"))
 
     matching_pem = next((pem for pem in pem_files if pem.stem == dmg_file.name), None)
 
@@ -197,36 +214,53 @@ async def extract_the_biggest_dmg(
     firmware: Firmware,
     ignored_firmwares_file: Path,
     *,
+    bundles_output: Path | None = None,
     skip_extraction: bool = False,
 ) -> Result[bool, str]:
     """
-    it would return a bool whether it the `System` has a parent or not
+    it would return a bool whether it the `System` has a parent or not,
+    the bundles are extracted to `bundles_output` (defaults to `output`)
     """
 
+    # not known until the zip is opened, `cleanup` must not assume it exists
+    biggest_dmg_file_path: Path | None = None
+
     def cleanup():
-        logger.info(f"Cleaning up extracted file: {biggest_dmg_file_path}")
-        biggest_dmg_file_path.unlink(missing_ok=True)
+        if biggest_dmg_file_path is not None:
+            logger.info(f"Cleaning up extracted file: {biggest_dmg_file_path}")
+            biggest_dmg_file_path.unlink(missing_ok=True)
 
         logger.info(f"Cleaning up original IPSW file: {dmg_file}")
         dmg_file.unlink(missing_ok=True)
+        verified_stamp_path(dmg_file).unlink(missing_ok=True)
 
     async def ignore():
         shutil.rmtree(output)
+        forget_metadata(output)
 
         await put_metadata(
             ignored_firmwares_file,
             "ignored",
-            lambda ign: (ign or []) + [firmware.version],
+            extend_list([firmware.version]),
         )
 
     logger.info(f"Extracting the biggest DMG from {dmg_file}")
 
     try:
         with zipfile.ZipFile(dmg_file) as zip_file:
-            biggest_dmg = max(zip_file.infolist(), key=lambda x: x.file_size)
+            # only the .dmg or .dmg.aea entries are candidates
+            biggest_dmg = max(
+                (
+                    info
+                    for info in zip_file.infolist()
+                    if info.filename.endswith((".dmg", ".dmg.aea"))
+                ),
+                key=lambda x: x.file_size,
+                default=None,
+            )
 
-            # not sure if there's one, idk, but if the biggest file is neithr a .dmg or .dmg.aea then ignore it
-            if not biggest_dmg.filename.endswith((".dmg", ".dmg.aea")):
+            # not sure if there's one, idk, but if there's neither a .dmg or .dmg.aea then ignore it
+            if biggest_dmg is None:
                 error_msg = "There was no .dmg in the .ipsw file, ignoring"
                 logger.warning(error_msg)
 
@@ -247,20 +281,17 @@ async def extract_the_biggest_dmg(
                 with (
                     zip_file.open(biggest_dmg) as source,
                     open(biggest_dmg_file_path, "wb") as target,
-                    tqdm(
+                    tqdm.wrapattr(
+                        source,
+                        "read",
                         total=biggest_dmg.file_size,
-                        unit="B",
-                        unit_scale=True,
                         desc=f"Extracting {biggest_dmg.filename}",
-                    ) as progress,
+                    ) as progress_source,
                 ):
-                    while True:
-                        chunk = source.read(8192)
-                        if not chunk:
-                            break
-
-                        target.write(chunk)
-                        progress.update(len(chunk))
+                    # inflating a multi-GB dmg takes a while, keep it off the event loop
+                    await asyncio.to_thread(
+                        shutil.copyfileobj, progress_source, target, COPY_BUFFER_SIZE
+                    )
 
             else:
                 logger.info("Skipping dmg extraction (file already exists)")
@@ -293,7 +324,7 @@ async def extract_the_biggest_dmg(
             "7z",
             "x",
             biggest_dmg_file_path,
-            f"-o{output}",
+            f"-o{bundles_output or output}",
             "-aos",  # overwrite
             "-bd",  # no progress
             "-y",
@@ -333,6 +364,7 @@ async def extract_the_biggest_dmg(
                     output,
                     firmware,
                     ignored_firmwares_file,
+                    bundles_output=bundles_output,
                     skip_extraction=True,
                 )
 
@@ -344,26 +376,47 @@ async def extract_the_biggest_dmg(
         cleanup()
 
 
+def _normalize_tarinfo(tarinfo: tarfile.TarInfo) -> tarfile.TarInfo:
+    """strips everything specific to the machine that extracted it, so the same bundle always gives the same tar (and hash)"""
+    tarinfo.mtime = 0
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ""
+
+    return tarinfo
+
+
+def _tar_and_hash_bundle(bundle: Path, output: Path) -> Dict[str, str | int]:
+    bundle_tar = output / bundle.with_suffix(".tar").name
+
+    # hash while writing, one pass over the bytes
+    with open(bundle_tar, "wb") as f:
+        writer = HashingWriter(f, "sha1")
+
+        with tarfile.open(
+            fileobj=writer, mode="w", format=tarfile.GNU_FORMAT  # type: ignore[arg-type]
+        ) as tar:
+            tar.add(
+                bundle,
+                arcname=bundle.name,
+                recursive=True,
+                filter=_normalize_tarinfo,
+            )
+
+    return {
+        "bundle_name": bundle_tar.stem,
+        "sha1": writer.hexdigest(),
+        "file_size": writer.tell(),
+        "created_at": datetime.now(UTC).isoformat(),
+    }
+
+
 async def tar_and_hash_bundles(
     bundles: List[Path],
+    output: Path,
 ) -> Result[List[Dict[str, str | int]], str]:
-    output_bundles: List[Dict[str, str | int]] = []
-
-    for bundle in bundles:
-        bundle_tar = bundle.with_suffix(".tar")
-
-        with tarfile.open(bundle_tar, "w", format=tarfile.PAX_FORMAT) as tar:
-            tar.add(bundle, arcname=bundle.name, recursive=True)
-
-        sha1 = await calculate_hash(bundle_tar, "sha1")
-        output_bundles.append(
-            {
-                "bundle_name": bundle_tar.stem,
-                "sha1": sha1,
-                "file_size": bundle_tar.stat().st_size,
-                "created_at": datetime.now(UTC).isoformat(),
-            }
-        )
+    output_bundles: List[Dict[str, str | int]] = await asyncio.gather(
+        *(asyncio.to_thread(_tar_and_hash_bundle, bundle, output) for bundle in bundles)
+    )
 
     return Ok(output_bundles)
 
@@ -393,26 +446,30 @@ async def bake_ipcc(
     bundles_metadata_path = version_path / "bundles.json"
     bundles_metadata_path.touch(exist_ok=True)
 
+    # where the bundles get extracted to before tarring them, preferably in RAM
+    bundles_path = version_path
+
     try:
         start_time = datetime.now(UTC)
 
-        if await is_firmware_version_ignored(ignored_firmwares_metadata_path, firmware.version):
-            shutil.rmtree(version_path, ignore_errors=True)
-            return False
-
-        if await is_firmware_version_done(base_metadata_path, firmware.version):
-            return False
-
-        ipsw_file = await download_file(firmware, version_path, session, ignored_firmwares_metadata_path)
+        ipsw_file = await download_file(
+            firmware,
+            version_path,
+            session,
+            ignored_firmwares_metadata_path,
+        )
 
         if isinstance(ipsw_file, Error):
             raise RuntimeError(ipsw_file)
 
+        bundles_path = bundles_scratch_dir(firmware, version_path)
+
         extract_big_result = await extract_the_biggest_dmg(
             ipsw_file.value,
             version_path,
             firmware,
             ignored_firmwares_metadata_path,
+            bundles_output=bundles_path,
         )
 
         if isinstance(extract_big_result, Error):
@@ -421,18 +478,18 @@ async def bake_ipcc(
         has_parent = extract_big_result.value
 
         bundles_folders = list(
-            bundles_glob(version_path, has_parent)
+            bundles_glob(bundles_path, has_parent)
         )
 
         new_bundles_folders = delete_non_bundles(
-            version_path, bundles_folders, has_parent
+            bundles_path, bundles_folders, has_parent
         )
 
         if isinstance(new_bundles_folders, Error):
             raise RuntimeError(new_bundles_folders)
 
         tarred_with_hash_bundles = await tar_and_hash_bundles(
-            new_bundles_folders.value
+            new_bundles_folders.value, version_path
         )
 
         # we don't need the .bundle folder after tarring it (compress it to a .tar)
@@ -447,7 +504,7 @@ async def bake_ipcc(
         await put_metadata(
             bundles_metadata_path,
             "bundles",
-            lambda acc: (acc or []) + tarred_bundles_value,
+            extend_list(tarred_bundles_value),
         )
 
         elapsed = (datetime.now(UTC) - start_time).total_seconds()
@@ -455,26 +512,32 @@ async def bake_ipcc(
         await put_metadata(
             base_metadata_path,
             "fw",
-            lambda acc: (acc or [])
-            + [
-                {
-                    "version": firmware.version,
-                    "buildid": firmware.buildid,
-                    "downloaded_at": datetime.now(UTC).isoformat(),
-                    "processing_time_sec": elapsed,
-                }
-            ],
+            extend_list(
+                [
+                    {
+                        "version": firmware.version,
+                        "buildid": firmware.buildid,
+                        "downloaded_at": datetime.now(UTC).isoformat(),
+                        "processing_time_sec": elapsed,
+                    }
+                ]
+            ),
         )
 
         return True
 
     except Exception as e:
         shutil.rmtree(version_path, ignore_errors=True)
+        forget_metadata(version_path)
 
         logger.error(
             f"Something went wrong, {e}\n traceback: {traceback.format_exc()}"
         )
 
+    finally:
+        if bundles_path != version_path:
+            shutil.rmtree(bundles_path, ignore_errors=True)
+
     return False
 
 
@@ -484,38 +547,80 @@ async def fetch_and_bake(
     product: str,
     devices_semaphore: asyncio.Semaphore,
     git_mode: bool,
+    signed_only: bool,
 ):
-    async with devices_semaphore:
+    model = f"{product}{code}"
+
+    # the api lookup is cheap, do it right away so that the device is ready to be
+    # baked as soon as a slot frees up instead of fetching it while holding the slot
+    response = await session.get(
+        f"https://api.ipsw.me/v4/device/{model}", params={"type": "ipsw"}
+    )
 
-        model = f"{product}{code}"
-        response = await session.get(
-            f"https://api.ipsw.me/v4/device/{model}", params={"type": "ipsw"}
+    if response.status != 200:
+        logger.error(f"Failed to fetch data for {model}: {await response.text()}")
+        return
+
+    parsed_data = Response.from_dict(await response.json())
+    if not parsed_data.firmwares:
+        logger.warning(f"No firmwares found for {model}")
+        return
+
+    ident = parsed_data.firmwares[0].identifier
+
+    async with devices_semaphore:
+        # read the metadata once per device instead of once per firmware
+        done_versions = await get_done_firmware_versions(Path(ident) / "metadata.json")
+        ignored_versions = await get_ignored_firmware_versions(
+            Path(ident) / "ignored_firmwares.json"
         )
 
-        if response.status != 200:
-            logger.error(f"Failed to fetch data for {model}: {await response.text()}")
-            return
+        # drop what doesn't need to be downloaded before doing anything,
+        # the api can list several builds of the same version but they all share
+        # the same version folder, so only keep the first one
+        firmwares: List[Firmware] = []
+        seen_versions: Set[str] = set()
 
-        parsed_data = Response.from_dict(await response.json())
-        if not parsed_data.firmwares:
-            logger.warning(f"No firmwares found for {model}")
-            return
+        for firmware in parsed_data.firmwares:
+            if (
+                firmware.version in seen_versions
+                or firmware.version in done_versions
+                or firmware.version in ignored_versions
+                or (signed_only and not firmware.signed)
+            ):
+                continue
+
+            seen_versions.add(firmware.version)
+            firmwares.append(firmware)
 
-        ident = parsed_data.firmwares[0].identifier
+        logger.info(f"{len(firmwares)}/{len(parsed_data.firmwares)} firmwares to process for {model}")
 
         processed_count = 0
-        for firmware in parsed_data.firmwares:
+        for firmware in firmwares:
             # if git_mode:
             #     await copy_previous_metadata(ident)
 
-            if await bake_ipcc(firmware, session):
+            if firmware.version in done_versions or firmware.version in ignored_versions:
+                continue
+
+            baked = await bake_ipcc(firmware, session)
+
+            # keep the sets in sync with the metadata, it might have been ignored while baking
+            ignored_versions |= await get_ignored_firmware_versions(
+                Path(ident) / "ignored_firmwares.json"
+            )
+
+            if baked:
+                done_versions.add(firmware.version)
 
                 processed_count += 1
                 if git_mode:
                     await process_files_with_git(ident, firmware.version)
 
         if processed_count == 0:
-            shutil.rmtree(ident)
+            # might not even be created if every firmware was filtered out
+            shutil.rmtree(ident, ignore_errors=True)
+            forget_metadata(Path(ident))
 
 async def main():
     app = argparse.ArgumentParser("OpeniTools-IPCC")
@@ -538,6 +643,14 @@ async def main():
         type=int
     )
 
+    app.add_argument(
+        "--signed-only",
+        help="Only process the firmwares that are still signed by Apple",
+        required=False,
+        default=False,
+        action="store_true",
+    )
+
     args = app.parse_args()
 
     git_mode: bool = args.git
@@ -546,16 +659,35 @@ async def main():
     os.chdir(Path(__file__).resolve().parents[1])
 
 
+    await ensure_ipsw_installed()
+
     if git_mode:
         await run_command("git switch files")
 
     devices_semaphore = asyncio.Semaphore(args.concurrent_jobs)
 
-    async with aiohttp.ClientSession() as session:
-        async with asyncio.TaskGroup() as main_group:
-            for product, codes in PRODUCT_CODES.items():
-                for code in codes:
-                    main_group.create_task(fetch_and_bake(session, code, product, devices_semaphore, git_mode))
+    # keep the connections to apple's cdn alive between firmwares and read big chunks at once,
+    # the downloads are multiple GBs so only time out when connecting or when the connection stalls
+    connector = aiohttp.TCPConnector(
+        limit=16,
+        limit_per_host=8,
+        ttl_dns_cache=600,
+        enable_cleanup_closed=True,
+    )
+
+    async with aiohttp.ClientSession(
+        connector=connector,
+        read_bufsize=2 << 20,
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300),
+    ) as session:
+        try:
+            async with asyncio.TaskGroup() as main_group:
+                for product, codes in PRODUCT_CODES.items():
+                    # a duplicated code would bake the same device twice
+                    for code in dict.fromkeys(codes):
+                        main_group.create_task(fetch_and_bake(session, code, product, devices_semaphore, git_mode, args.signed_only))
+        finally:
+            await flush_metadata()
 
 
 if __name__ == "__main__":
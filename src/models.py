@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from datetime import datetime
 from typing import Generic, List, TypeVar, Union
 
@@ -19,7 +19,7 @@ class Error(Generic[E]):
 Result = Union[Ok[T], Error[E]]
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Firmware:
     identifier: str
     version: str
@@ -34,25 +34,19 @@ class Firmware:
 
     @staticmethod
     def from_dict(data: dict) -> "Firmware":
+        # the api might send extra keys, only keep the ones we know about
         return Firmware(
-            identifier=data["identifier"],
-            version=data["version"],
-            buildid=data["buildid"],
-            sha1sum=data["sha1sum"],
-            md5sum=data["md5sum"],
-            filesize=data["filesize"],
-            url=data["url"],
+            **{key: data[key] for key in _FIRMWARE_FIELDS if key in data},
             releasedate=datetime.fromisoformat(data["releasedate"])
             if data.get("releasedate")
             else None,
             uploaddate=datetime.fromisoformat(data["uploaddate"])
             if data.get("uploaddate")
             else None,
-            signed=data["signed"],
         )
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Response:
     name: str
     identifier: str
@@ -65,11 +59,11 @@ class Response:
     @staticmethod
     def from_dict(data: dict) -> "Response":
         return Response(
-            name=data["name"],
-            identifier=data["identifier"],
+            **{key: data[key] for key in _RESPONSE_FIELDS if key in data},
             firmwares=[Firmware.from_dict(fw) for fw in data["firmwares"]],
-            boardconfig=data["boardconfig"],
-            platform=data["platform"],
-            cpid=data["cpid"],
-            bdid=data["bdid"],
         )
+
+
+# the fields that are copied as is from the api's json
+_FIRMWARE_FIELDS = {f.name for f in fields(Firmware)} - {"releasedate", "uploaddate"}
+_RESPONSE_FIELDS = {f.name for f in fields(Response)} - {"firmwares"}
@@ -1,3 +1,4 @@
+import asyncio
 import plistlib
 import zipfile
 from pathlib import Path
@@ -79,7 +80,8 @@ async def decrypt_dmg(
 async def _extract_encrypted_dmg(dmg_file: Path, key: str) -> Result[None, str]:
     temp_file = dmg_file.parent / (dmg_file.name + ".temp")
 
-    vfdecrypt.decrypt_vf(dmg_file, temp_file, key)
+    # decrypting a whole dmg takes minutes, don't block the other jobs meanwhile
+    await asyncio.to_thread(vfdecrypt.decrypt_vf, dmg_file, temp_file, key)
     # _, stderr, returncode = await run_command(
     #     f"vfdecrypt -i {dmg_file} -k {key} -o {temp_file}", check=False
     # )
@@ -5,7 +5,8 @@ import aiohttp
 
 from models import Error, Firmware, Ok, Result
 from utils import logger
-from utils.fs import (cleanup_file, is_file_ready, put_metadata,
+from utils.fs import (cleanup_file, extend_list, forget_metadata,
+                      is_file_ready, put_metadata, stamp_verified_file,
                       write_with_progress)
 from utils.git import process_files_with_git
 from utils.hash import compare_either_hash
@@ -15,10 +16,11 @@ async def download_file(
     firmware: Firmware,
     version_folder: Path,
     session: aiohttp.ClientSession,
-    ignored_firmwares_file: Path
+    ignored_firmwares_file: Path,
 ) -> Result[Path, str]:
     """
-    Downloads the firmware and returns the path to the downloaded .ipsw file
+    Downloads the firmware and returns the path to the downloaded .ipsw file,
+    once verified, the file is stamped (see `stamp_verified_file`) so it isn't re-hashed on the next run
     """
     file_path = version_folder / f"{firmware.identifier}-{firmware.version}.ipsw"
 
@@ -29,10 +31,7 @@ async def download_file(
 
     # 2) Do the HTTP GET
     try:
-        resp = await session.get(
-            firmware.url,
-            timeout=aiohttp.ClientTimeout(total=1000)
-        )
+        resp = await session.get(firmware.url)
         resp.raise_for_status()
     except aiohttp.ClientResponseError as e:
         await cleanup_file(file_path)
@@ -42,10 +41,12 @@ async def download_file(
             await put_metadata(
                 ignored_firmwares_file,
                 "ignored",
-                lambda ign: (ign or []) + [firmware.version],
+                extend_list([firmware.version]),
             )
 
-            shutil.rmtree(Path(firmware.identifier) / firmware.version, ignore_errors=True)
+            version_path = Path(firmware.identifier) / firmware.version
+            shutil.rmtree(version_path, ignore_errors=True)
+            forget_metadata(version_path)
             await process_files_with_git(firmware.identifier, firmware.version, "ignored {version} for {ident}")
 
         return Error(f"Client Response Error: {e}")
@@ -61,13 +62,16 @@ async def download_file(
     # 3) Stream it to disk with a tqdm progress bar
     content_length = int(resp.headers.get("Content-Length", 0))
     try:
-        await write_with_progress(resp, file_path, content_length)
+        sha1 = await write_with_progress(resp, file_path, content_length)
     except Exception as e:
         await cleanup_file(file_path)
         return Error(f"Error writing file: {e}")
 
-    # 4) Final hash check
-    if not await compare_either_hash(file_path, firmware):
+    # 4) Final hash check, the sha1 was computed while streaming,
+    # only re-read the file if we have to fall back to the md5
+    if sha1 == firmware.sha1sum.strip() or await compare_either_hash(file_path, firmware):
+        stamp_verified_file(file_path, firmware)
+    else:
         logger.warning(f"Hash mismatch for {file_path}")
 
     return Ok(file_path)
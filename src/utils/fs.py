@@ -1,10 +1,14 @@
 import asyncio
-import glob
+import errno
+import hashlib
 import json
+import os
 import shutil
+from collections import defaultdict
 from datetime import UTC, datetime
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional, TypeVar
+from typing import (Any, Callable, DefaultDict, Dict, List, Optional, Set,
+                    TypeVar)
 
 import aiofiles
 import aiohttp
@@ -14,40 +18,142 @@ from models import Error, Firmware, Ok, Result
 from utils import logger
 from utils.hash import compare_either_hash
 
+try:
+    import orjson
+except ImportError:  # optional, much faster than the stdlib json
+    orjson = None
+
 # for json writing callbacks
 J = TypeVar("J")
 
+def _json_dumps(data: Any) -> bytes:
+    # still indented, the metadata files are committed and diffed
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+
+    return json.dumps(data, indent=2, sort_keys=True, ensure_ascii=False).encode()
+
+def _json_loads(data: bytes) -> Any:
+    # orjson's decode error is a subclass of `json.JSONDecodeError`
+    if orjson is not None:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
+# the parsed metadata files, shared by all the jobs, and written back to the disk
+# `METADATA_FLUSH_DELAY_SEC` after their last update
+METADATA_FLUSH_DELAY_SEC = 0.5
+_METADATA_CACHE: Dict[Path, Dict[str, Any]] = {}
+_METADATA_LOCKS: DefaultDict[Path, asyncio.Lock] = defaultdict(asyncio.Lock)
+_PENDING_FLUSHES: Dict[Path, asyncio.TimerHandle] = {}
+
+PROGRESS_UPDATE_BYTES = 4 << 20
+
+# the extracted carrier bundles are a few hundred MBs, leave plenty of headroom
+TMPFS_PATH = Path("/dev/shm")
+TMPFS_MIN_FREE_BYTES = 2 << 30
+
+def bundles_scratch_dir(firmware: Firmware, fallback: Path) -> Path:
+    """
+    returns a directory in RAM (tmpfs) to extract the bundles to, if there's one with enough space,
+    otherwise `fallback`
+    """
+
+    try:
+        if TMPFS_PATH.is_dir() and shutil.disk_usage(TMPFS_PATH).free >= TMPFS_MIN_FREE_BYTES:
+            scratch = TMPFS_PATH / f"ipcc-{os.getpid()}-{firmware.identifier}-{firmware.version}"
+            scratch.mkdir(exist_ok=True)
+            return scratch
+
+    except OSError as e:
+        logger.warning(f"Unable to use {TMPFS_PATH} for extraction: {e}")
+
+    return fallback
+
+def _file_stamp(file_path: Path, firmware: Firmware) -> Dict[str, str | int]:
+    stat = file_path.stat()
+
+    return {
+        "file_size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha1": firmware.sha1sum.strip(),
+    }
+
+def verified_stamp_path(file_path: Path) -> Path:
+    """the sidecar file next to `file_path` that says it was already verified"""
+    return file_path.with_name(file_path.name + ".verified")
+
+def stamp_verified_file(file_path: Path, firmware: Firmware) -> None:
+    """
+    remembers that `file_path` was verified against the firmware's hash, as long as
+    its size and mtime don't change `is_file_ready` won't hash it again
+    """
+    verified_stamp_path(file_path).write_bytes(_json_dumps(_file_stamp(file_path, firmware)))
+
+def _is_stamped(file_path: Path, firmware: Firmware) -> bool:
+    try:
+        stamp = _json_loads(verified_stamp_path(file_path).read_bytes())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+
+    return stamp == _file_stamp(file_path, firmware)
+
 async def is_file_ready(file_path: Path, firmware: Firmware) -> bool:
     """
     returns True if the file exists and the hash matches, otherwise remove it and return False
     """
-    
+
     if file_path.exists():
+        if _is_stamped(file_path, firmware):
+            logger.info("ipsw file already exists and was already verified, using it")
+            return True
+
         if await compare_either_hash(file_path, firmware):
             logger.info("ipsw file already exists, using it")
+            stamp_verified_file(file_path, firmware)
             return True
 
         logger.info("Detected a corrupted file, redownloading")
         file_path.unlink()
 
+    verified_stamp_path(file_path).unlink(missing_ok=True)
+
     return False
 
 async def write_with_progress(
     resp: aiohttp.ClientResponse,
     file_path: Path,
     total_bytes: int,
-    chunk_size: int = 8_192
-) -> None:
-    """Helper to write response.content → disk with a tqdm bar."""
+    chunk_size: int = 131_072
+) -> str:
+    """
+    Helper to write response.content → disk with a tqdm bar,
+    returns the sha1 of the written bytes so the file doesn't have to be re-read
+    """
     file_path.parent.mkdir(parents=True, exist_ok=True)
 
+    sha1 = hashlib.sha1()
+
     # Open sync—in practice, IPSW writes are large and async file libs
     # often perform worse than plain open().
+    written = 0
+    reported = 0
+
     with open(file_path, "wb") as f, \
          tqdm(total=total_bytes, unit="B", unit_scale=True, desc=str(file_path)) as bar:
         async for chunk in resp.content.iter_chunked(chunk_size):
             f.write(chunk)
-            bar.update(len(chunk))
+            sha1.update(chunk)
+
+            # updating the bar on every chunk is pure overhead, do it every few MBs
+            written += len(chunk)
+            if written - reported >= PROGRESS_UPDATE_BYTES:
+                bar.update(written - reported)
+                reported = written
+
+        bar.update(written - reported)
+
+    return sha1.hexdigest()
 
 
 async def cleanup_file(file_path: Path) -> None:
@@ -59,33 +165,110 @@ async def cleanup_file(file_path: Path) -> None:
 
 
 
-async def put_metadata(
-    metadata_path: Path, key: str, callback: Callable[[Optional[J]], J]
-) -> Result[None, str]:
-    """Read & update JSON metadata using a callback."""
-    logger.info(f"updating {metadata_path}")
-    try:
-        try:
-            async with aiofiles.open(metadata_path, "r") as f:
-                    text = await f.read()
+def extend_list(items: List[J]) -> Callable[[Optional[List[J]]], List[J]]:
+    """`put_metadata` callback that extends the stored list in place instead of copying it."""
+
+    def callback(acc: Optional[List[J]]) -> List[J]:
+        if acc is None:
+            acc = []
+
+        acc.extend(items)
+        return acc
+
+    return callback
+
 
-                    logger.debug(f"{metadata_path} content: '{text}'")
-                    metadata = json.loads(text) if text.strip() else {}
+async def _load_metadata(metadata_path: Path) -> Dict[str, Any]:
+    """returns the cached metadata, reading it from the disk on the first access"""
+    if metadata_path not in _METADATA_CACHE:
+        try:
+            async with aiofiles.open(metadata_path, "rb") as f:
+                data = await f.read()
 
+                logger.debug(f"{metadata_path} content: '{data!r}'")
+                metadata = _json_loads(data) if data.strip() else {}
 
         except FileNotFoundError:
             metadata = {}
 
-        logger.debug(f"before: {metadata = }")
+        _METADATA_CACHE[metadata_path] = metadata
+
+    return _METADATA_CACHE[metadata_path]
+
+
+def _flush_metadata(metadata_path: Path) -> None:
+    _PENDING_FLUSHES.pop(metadata_path, None)
+
+    metadata = _METADATA_CACHE.get(metadata_path)
+    if metadata is None:
+        return
+
+    try:
+        metadata_path.write_bytes(_json_dumps(metadata))
+    except FileNotFoundError:
+        # the folder was removed in the meantime (e.g. a failed firmware), nothing to keep
+        logger.debug(f"{metadata_path} is gone, dropping its metadata")
+        _METADATA_CACHE.pop(metadata_path, None)
+
+
+def forget_metadata(directory: Path) -> None:
+    """
+    drops the cached metadata of every file under `directory`, to be called after removing it,
+    otherwise the stale metadata would be served and written back once the folder is recreated
+    """
+    directory = directory.absolute()
+
+    for metadata_path in list(_METADATA_CACHE.keys() | _PENDING_FLUSHES.keys() | _METADATA_LOCKS.keys()):
+        if not metadata_path.is_relative_to(directory):
+            continue
+
+        if pending := _PENDING_FLUSHES.pop(metadata_path, None):
+            pending.cancel()
+
+        _METADATA_CACHE.pop(metadata_path, None)
+
+        # whoever holds it still has to release it
+        if (lock := _METADATA_LOCKS.get(metadata_path)) is not None and not lock.locked():
+            del _METADATA_LOCKS[metadata_path]
+
+
+async def flush_metadata() -> None:
+    """writes all the pending metadata to the disk right away (before committing, exiting, ...)"""
+    for metadata_path, handle in list(_PENDING_FLUSHES.items()):
+        handle.cancel()
+
+        async with _METADATA_LOCKS[metadata_path]:
+            _flush_metadata(metadata_path)
+
+
+async def put_metadata(
+    metadata_path: Path, key: str, callback: Callable[[Optional[J]], J]
+) -> Result[None, str]:
+    """
+    Update JSON metadata using a callback, the metadata is kept in memory
+    and written to the disk shortly after (see `flush_metadata`)
+    """
+    logger.info(f"updating {metadata_path}")
+    metadata_path = metadata_path.absolute()
+
+    try:
+        async with _METADATA_LOCKS[metadata_path]:
+            metadata = await _load_metadata(metadata_path)
+
+            logger.debug(f"before: {metadata = }")
 
-        metadata[key] = callback(metadata.get(key))
-        metadata["updated_at"] = datetime.now(UTC).isoformat()
+            metadata[key] = callback(metadata.get(key))
+            metadata["updated_at"] = datetime.now(UTC).isoformat()
 
+            logger.debug(f"after: {metadata = }")
 
-        logger.debug(f"after: {metadata = }")
+            # debounce, many updates in a row end up as a single write
+            if pending := _PENDING_FLUSHES.get(metadata_path):
+                pending.cancel()
 
-        async with aiofiles.open(metadata_path, "w") as f:
-            await f.write(json.dumps(metadata, indent=4))
+            _PENDING_FLUSHES[metadata_path] = asyncio.get_running_loop().call_later(
+                METADATA_FLUSH_DELAY_SEC, _flush_metadata, metadata_path
+            )
 
         return Ok(None)
 
@@ -96,14 +279,26 @@ async def put_metadata(
 
 
 def bundles_glob(path: Path, has_parent: bool = False) -> List[Path]:
-    return list(
-        map(
-            lambda s: Path(s).resolve(),
-            glob.glob(
-                f"{path}/{'*/' if has_parent else ''}System/Library/Carrier Bundles/**/*.bundle"
-            ),
+    # the bundles are one level deep (`Carrier Bundles/iPhone/*.bundle`), don't recurse
+    # or the bundles nested inside of other bundles would be picked up too
+    return [
+        bundle.resolve()
+        for bundle in path.glob(
+            f"{'*/' if has_parent else ''}System/Library/Carrier Bundles/*/*.bundle"
         )
-    )
+    ]
+
+
+def _move_dir(src: Path, dst: Path) -> None:
+    try:
+        # a plain rename, constant time, as long as it's on the same filesystem
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+        shutil.copytree(src, dst, symlinks=True)
+        shutil.rmtree(src)
 
 
 def delete_non_bundles(
@@ -111,7 +306,7 @@ def delete_non_bundles(
 ) -> Result[List[Path], str]:
     try:
         for bundle in bundles:
-            shutil.move(bundle, base_path / bundle.name)
+            _move_dir(bundle, base_path / bundle.name)
 
         if has_parent:
             system_dirs = list(base_path.glob("*/System"))
@@ -121,8 +316,9 @@ def delete_non_bundles(
         else:
             path = base_path / "System"
 
+        # don't ignore the errors, a leftover `System` would end up next to the bundles
         if path.exists():
-            shutil.rmtree(path, ignore_errors=True)
+            shutil.rmtree(path)
 
         return Ok([base_path / bundle.name for bundle in bundles])
 
@@ -177,39 +373,27 @@ async def system_has_parent(dmg_file: Path) -> Result[bool, str]:
     return Ok(len(lines) > 10)
 
 async def _get_metadata_json(file_path: Path) -> Dict[str, Any]:
+    # the cached one might not be written to the disk yet
+    if (cached := _METADATA_CACHE.get(file_path.absolute())) is not None:
+        return cached
+
     try:
-        async with aiofiles.open(file_path, 'r', encoding='utf-8') as file:
-            metadata = json.loads((await file.read()) or "{}")
+        async with aiofiles.open(file_path, 'rb') as file:
+            metadata = _json_loads((await file.read()) or b"{}")
 
     except (FileNotFoundError, json.JSONDecodeError):
         metadata = {}
 
     return metadata
 
-async def is_firmware_version_ignored(file_path: Path, firm_version: str) -> bool:
+async def get_ignored_firmware_versions(file_path: Path) -> Set[str]:
     metadata = await _get_metadata_json(file_path)
-    
-    firmware_list: List[str] = metadata.get("ignored", [])
-    
-    for fm in firmware_list:
-        try:
-            if fm == firm_version:
-                return True
-        except KeyError:
-            continue
-    
-    return False
 
-async def is_firmware_version_done(file_path: Path, firm_version: str) -> bool:
+    return set(metadata.get("ignored", []))
+
+async def get_done_firmware_versions(file_path: Path) -> Set[str]:
     metadata = await _get_metadata_json(file_path)
-    
+
     firmware_list: List[Dict[str, Any]] = metadata.get("fw", [])
-    
-    for fm in firmware_list:
-        try:
-            if fm["version"] == firm_version:
-                return True
-        except KeyError:
-            continue
-    
-    return False
+
+    return {fm["version"] for fm in firmware_list if "version" in fm}
@@ -4,6 +4,7 @@ from pathlib import Path
 import aiofiles
 
 from utils import logger
+from utils.fs import flush_metadata
 from utils.shell import run_command
 
 # only one can upload and use git
@@ -13,6 +14,9 @@ GIT_LOCK = asyncio.Lock()
 async def process_files_with_git(ident: str, version: str, message: str = 'added {version} ipcc files for {ident}'):
     logger.debug("waiting for the git lock")
     async with GIT_LOCK:
+        # the metadata must be on the disk before adding it
+        await flush_metadata()
+
         await run_command(f"git add {ident}")
 
         # await run_command("git stash push")
@@ -1,28 +1,61 @@
+import asyncio
 import hashlib
 from pathlib import Path
-from typing import Literal
+from typing import BinaryIO, Literal
 
 from models import Firmware
 
+# big enough to keep the (hardware accelerated) digest busy
+# and to amortize the per-read python overhead
+HASH_BUFFER_SIZE = 1 << 20
 
-async def calculate_hash(file_path: Path, algo: Literal["sha1", "md5"]) -> str:
+
+class HashingWriter:
+    """
+    A write-only file wrapper that hashes everything that goes through it,
+    so the written file doesn't have to be read back to get its hash
+    """
+
+    def __init__(self, file: BinaryIO, algo: Literal["sha1", "md5"]):
+        self._file = file
+        self._offset = 0
+        self.hash = getattr(hashlib, algo)()
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        self._offset += len(data)
+        return self._file.write(data)
+
+    def tell(self) -> int:
+        return self._offset
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+def _hash_sync(file_path: Path, algo: Literal["sha1", "md5"]) -> str:
     hash_func = getattr(hashlib, algo)()
-    
-    with open(file_path, "rb") as f:
-        while True:
-            chunk = f.read(1024 * 10000)
-            if not chunk:
-                break
-            hash_func.update(chunk)
+
+    buffer = memoryview(bytearray(HASH_BUFFER_SIZE))
+
+    with open(file_path, "rb", buffering=0) as f:
+        while n := f.readinto(buffer):
+            hash_func.update(buffer[:n])
 
     return hash_func.hexdigest()
 
+
+async def calculate_hash(file_path: Path, algo: Literal["sha1", "md5"]) -> str:
+    # hashlib releases the GIL on big updates, so hashing in a thread
+    # doesn't block the event loop while a multi-GB ipsw is being read
+    return await asyncio.to_thread(_hash_sync, file_path, algo)
+
 async def compare_either_hash(file_path: Path, firmware: Firmware) -> bool:
     sha1 = await calculate_hash(file_path, "sha1")
 
     if sha1.strip() == firmware.sha1sum.strip():
         return True
-    
+
     md5 = await calculate_hash(file_path, "md5")
 
     if md5.strip() == firmware.md5sum.strip():